@@ -21,7 +21,10 @@ import os
 import csv
 import math
 import random
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from psychopy import visual, core, event, gui, monitors
+from psychopy.hardware import keyboard
 
 
 ########################################################################################################################
@@ -46,42 +49,36 @@ IMAGE_PATH = os.path.join(EXP_PATH, 'images')  # Path to store any required expe
 BG_color     = [0, 0, 0]  # Set a background color, currently grey
 FIX_color    = [-1, -1, -1]  # Set the fixation color, currently black
 TEXT_color   = [-1, -1, -1]  # The text color, currently white
-TRIAL_colorS1 = [[-1, -1, -1],  # Black
-                 [-1, -1, 1],   # Blue
-                 [-1, 1, -1],   # Green
-                 [-1, 1, 1],    # Cyan
-                 [1, -1, -1],   # Red
-                 [1, -1, 1],    # Purple
-                 [1, 1, -1],    # Yellow
-                 [1, 1, 1]]     # White
-TRIAL_colorS2 = [[-1, -1, -1],  # Black
-                 [-1, -1, 1],   # Blue
-                 [-1, 1, -1],   # Green
-                 [-1, 1, 1],    # Cyan
-                 [1, -1, -1],   # Red
-                 [1, -1, 1],    # Purple
-                 [1, 1, -1],    # Yellow
-                 [1, 1, 1]]     # White
-
-
-color_NAMES  = {str([-1,-1,-1]) : 'Black',
-                 str([-1,-1,1])  : 'Blue',
-                 str([-1,1,-1])  : 'Green',
-                 str([-1,1,1])   : 'Cyan',
-                 str([1,-1,-1])  : 'Red',
-                 str([1,-1,1])   : 'Purple',
-                 str([1,1,-1])   : 'Yellow',
-                 str([1,1,1])    : 'White'}
+color_RGBS   = [[-1, -1, -1],  # Black
+                [-1, -1, 1],   # Blue
+                [-1, 1, -1],   # Green
+                [-1, 1, 1],    # Cyan
+                [1, -1, -1],   # Red
+                [1, -1, 1],    # Purple
+                [1, 1, -1],    # Yellow
+                [1, 1, 1]]     # White
+color_NAMES  = ('Black', 'Blue', 'Green', 'Cyan', 'Red', 'Purple', 'Yellow', 'White')
+
+# Trial colors are stored as indices into color_RGBS and color_NAMES
+TRIAL_colorS1 = list(range(len(color_RGBS)))
+TRIAL_colorS2 = list(range(len(color_RGBS)))
 
 NUM_TYPE = 6  # Number of different trial types
 NUM_REPS = 50  # Number of repetitions for each different trial type
 
+NUM_STIMULI_BY_TYPE = (1, 2, 3, 4, 8, 12)  # The load number for each trial type number
+
 # Note that all sizing is in visual degrees
 FIXATION_SIZE   = 0.1  # Size of the fixation at the center of the screen in visual degree
 STIM_POS_RADIUS = 4  # Number of visual degrees between the center and stimuli
 STIM_SIZE       = 0.65  # Size of the stimuli in visual degrees, length and width
 STIM_THICKNESS  = 1  # The thickness of the outline of the stimuli
 
+# The 12 possible stimuli positions evenly spaced around the center, computed once for all trials
+STIM_RING = [(math.cos(math.radians(30 * pos)) * STIM_POS_RADIUS, math.sin(math.radians(30 * pos)) * STIM_POS_RADIUS)
+             for pos in range(12)]
+HIDDEN_POS = (1000, 1000)  # A position far off the screen used to hide the stimuli not used in a trial
+
 TEXT_HEIGHT = 1   # The height in visual degrees of instruction text
 TEXT_WRAP   = 50  # The character limit of each line of text before word wrap
 
@@ -90,6 +87,7 @@ ITI_TIME   = 0.5  # The time in seconds between trials
 STIM_TIME  = 0.5  # The time in seconds to display the stimuli
 DELAY_TIME = 0.9  # The time in seconds between stimuli and probe
 BREAK_TIME = 0.75  # The time in seconds between break end and trial start
+HOG_TIME   = 0.002  # The time in seconds at the end of each wait where the CPU is hogged for accurate timing
 
 INS_MSG   = "You will be presented with colored squares, try to remember their colors.\n\n"
 INS_MSG  += "For each trial, there will follow a second set of squares in the same locations.\n\n"
@@ -119,13 +117,15 @@ class Trial(object):
     set up and run a trial.
     """
 
-    def __init__(self, trial_num, rep_num):
+    def __init__(self, trial_num, rep_num, rng):
         """Class constructor function initializes which trial format to follow from parameter input, also calls the
         functions to set the memory trial olour and location.
         trial_num: Integer
             The trial number used to determine the trial format.
         rep_num: Integer
             The rep number of this trial, used to determine color change.
+        rng: random.Random
+            The seeded random generator used to build the experiment trials.
         """
 
         self.rep_num     = rep_num
@@ -133,68 +133,75 @@ class Trial(object):
         self.num_stimuli = 0
 
         self.stim_positions = []
+        self.pos_array      = None
 
         self.change        = False
-        self.stim_colors  = []
-        self.probe_colors = []
+        self.stim_color_idx  = []
+        self.probe_color_idx = []
 
-        # Determine the load number for this trial based on the trial type number
-        if trial_num == 0:
-            self.num_stimuli = 1
-        elif trial_num == 1:
-            self.num_stimuli = 2
-        elif trial_num == 2:
-            self.num_stimuli = 3
-        elif trial_num == 3:
-            self.num_stimuli = 4
-        elif trial_num == 4:
-            self.num_stimuli = 8
-        elif trial_num == 5:
-            self.num_stimuli = 12
+        self.stim_color_names  = []
+        self.probe_color_names = []
 
+        self.color_array       = None
+        self.probe_color_array = None
 
+        # Determine the load number for this trial based on the trial type number
+        self.num_stimuli = NUM_STIMULI_BY_TYPE[trial_num]
+
+        self.set_positions(rng)  # Set the stimuli positions for the Trial
+        self.set_colors(rng)  # Set the stimuli colors for the Trial
     # end def __init__
 
-    def set_positions(self):
+    def set_positions(self, rng):
         """This function will determine the location (left or right) for the memory sample and distraction sample. Uses
         even and odd numbers to ensure an even distribution of left and right positioning. Also generates the
         coordinates for the gui and results print out.
+        rng: random.Random
+            The seeded random generator used to build the experiment trials.
         """
 
-        # Generate a list of 12 positions around the center
-        for pos in xrange(12):
-            angle = math.radians(360 / 12 * pos)
-            self.stim_positions.append([math.cos(angle)*STIM_POS_RADIUS, math.sin(angle)*STIM_POS_RADIUS])
-        random.shuffle(self.stim_positions)  # Shuffle the list of positions
+        # Pick the correct number of stimuli positions at random from the 12 positions around the center
+        self.stim_positions = rng.sample(STIM_RING, self.num_stimuli)
 
-        # Cut the position list to the correct number of stimuli required
-        self.stim_positions = self.stim_positions[:self.num_stimuli]
+        # Store the positions for all 12 stimuli squares, moving the squares not used off the screen
+        self.pos_array = np.asarray(self.stim_positions + [HIDDEN_POS] * (12 - self.num_stimuli), dtype=np.float32)
     # end def set_positions
 
-    def set_colors(self):
+    def set_colors(self, rng):
         """This function is used to randomly generate memory stimuli colors and memory probe colors based on a color
         match or not.
+        rng: random.Random
+            The seeded random generator used to build the experiment trials.
         """
 
-        # Shuffle the list of available colors
-        random.shuffle(TRIAL_colorS1)
-        random.shuffle(TRIAL_colorS2)
-        TRIAL_colorS = TRIAL_colorS1 + TRIAL_colorS2
+        # Draw a shuffled copy of the available colors, leaving the module level color lists untouched
+        color_pool = rng.sample(TRIAL_colorS1, len(TRIAL_colorS1)) + rng.sample(TRIAL_colorS2, len(TRIAL_colorS2))
+
         # Create the lists of stimuli and probe colors
-        for color in TRIAL_colorS:
-            self.stim_colors.append(color)
-            self.probe_colors.append(color)
+        self.stim_color_idx  = color_pool[:self.num_stimuli]
+        self.probe_color_idx = list(self.stim_color_idx)
 
-        # If a change is present replace on of the colors in the probe list with a new color
+        # If a change is present replace one of the colors in the probe list with a new color, using a color not
+        # already on screen when there is one, otherwise any color different from the one being replaced
         if (self.rep_num % 2) == 0:
             self.change = True
-            rand_1 = random.randint(0, self.num_stimuli-1)
-            rand_2 = random.randint(self.num_stimuli, 13)
-            self.probe_colors[rand_1] = self.probe_colors[rand_2]
-
-        # Cut the color lists to the correct number of stimuli required
-        self.stim_colors  = self.stim_colors[:self.num_stimuli]
-        self.probe_colors = self.probe_colors[:self.num_stimuli]
+            change_idx = rng.randrange(self.num_stimuli)
+            new_colors = [color for color in TRIAL_colorS1 if color not in self.stim_color_idx]
+            if not new_colors:
+                new_colors = [color for color in TRIAL_colorS1 if color != self.stim_color_idx[change_idx]]
+            self.probe_color_idx[change_idx] = rng.choice(new_colors)
+
+        # Build the color names for the output file now so this is not done during experiment runtime
+        padding = ['NaN'] * (12 - self.num_stimuli)
+        self.stim_color_names  = [color_NAMES[color] for color in self.stim_color_idx] + padding
+        self.probe_color_names = [color_NAMES[color] for color in self.probe_color_idx] + padding
+
+        # Store the colors for all 12 stimuli squares, the squares not used are set to the background color
+        bg_padding = [BG_color] * (12 - self.num_stimuli)
+        self.color_array       = np.asarray([color_RGBS[color] for color in self.stim_color_idx] + bg_padding,
+                                            dtype=np.float32)
+        self.probe_color_array = np.asarray([color_RGBS[color] for color in self.probe_color_idx] + bg_padding,
+                                            dtype=np.float32)
     # end def set_colors
 
 # end class Trial
@@ -258,36 +265,33 @@ def set_psychopy():
 
     # Build the window for psychopy to run the experiment in
     win = visual.Window(fullscr=True, screen=0, allowGUI=False, allowStencil=False, monitor=mon, color=BG_color,
-                        colorSpace='rgb', units='deg')
+                        colorSpace='rgb', units='deg', waitBlanking=True)
 
     # Set up an event clock for timing in trials
     event_clock = core.Clock()
 
     # Set up an event catcher to collect keyboard and mouse responses
     mouse    = event.Mouse(win=win)
-    key_resp = event.BuilderKeyResponse()
+    key_resp = keyboard.Keyboard()  # Timestamps key presses in the keyboard backend rather than when they are polled
 
     return win, mon, event_clock, key_resp, mouse
 # End def set_psychopy
 
 
-def set_trials():
+def set_trials(subj_num):
+    """Build and randomize the full set of experiment trials.
+    subj_num: String
+        The subject number, used as the random seed so we can recreate the experiment.
     """
 
-    """
+    # Seed a random generator with the subject number so we can recreate the experiment
+    rng = random.Random(int(subj_num))
 
     # Build all trials before we start experiment
-    test_set = []
-
-    for rep in xrange(NUM_REPS):
-        for trial in xrange(NUM_TYPE):
-            set_trial = Trial(trial, rep)  # Initialize the Trial
-            set_trial.set_positions()  # Set the stimuli positions for the Trial
-            set_trial.set_colors()  # Set the stimuli colors for the Trial
-            test_set.append(set_trial)
+    test_set = [Trial(trial, rep, rng) for rep in range(NUM_REPS) for trial in range(NUM_TYPE)]
 
     # Randomize our trial order
-    random.shuffle(test_set)
+    rng.shuffle(test_set)
 
     return test_set
 # end def set_trials
@@ -330,20 +334,15 @@ def display_fixation(win, clk, fix, dur):
         The duration of time to display the fixation on screen.
     """
 
-    event_clock.reset()
-
-    while True:
-        if clk.getTime() >= dur:
-            break
-        fix.draw(True)
-        win.flip()
-        if clk.getTime() >= dur:
-            break
+    clk.reset()
+    fix.draw()
+    win.flip()
+    core.wait(dur - clk.getTime(), hogCPUperiod=HOG_TIME)
 
     FT = clk.getTime()
 
     if VERBOSE:
-        print "FIXATION SCREEN:", FT
+        print("FIXATION SCREEN:", FT)
 # end def display_fixation
 
 
@@ -362,19 +361,19 @@ subj_num, subj_file = setup_subject()
 if not os.path.exists(SAVE_PATH):
     os.makedirs(SAVE_PATH)
 
-# Seed random with the subject number so we can recreate the experiment
-random.seed(int(subj_num))
+# Open the output file for writing and write the headers, rows are buffered and only flushed to disk at break screens
+csv_file = open(subj_file, 'w', newline='', buffering=65536)
+writer   = csv.writer(csv_file)
+writer.writerow(HEADER_LIST)
 
-# Write output headers to subject save file
-with open(subj_file, 'w') as csv_file:
-    writer = csv.writer(csv_file)
-    writer.writerow(HEADER_LIST)
+# Set the experiment trials in the background while psychopy sets up the window
+with ThreadPoolExecutor(max_workers=1) as executor:
+    trials_future = executor.submit(set_trials, subj_num)
 
-# Set up psychopy
-win, mon, event_clock, key_resp, mouse = set_psychopy()
+    # Set up psychopy
+    win, mon, event_clock, key_resp, mouse = set_psychopy()
 
-# Set the experiment trials
-test_set = set_trials()
+    test_set = trials_future.result()
 
 # Build all experiment stimuli, *Note this needs to be done before experiment runtime to ensure proper timing
 display_text = visual.TextStim(win=win, ori=0, name='text', text="", font='Arial', pos=[0, 0], height=TEXT_HEIGHT,
@@ -382,19 +381,16 @@ display_text = visual.TextStim(win=win, ori=0, name='text', text="", font='Arial
 
 fixation = visual.Circle(win, pos=[0, 0], radius=FIXATION_SIZE, lineColor=FIX_color, fillColor=FIX_color)
 
-stimuli = []
-for target in xrange(12):
-    stimuli.append(visual.Rect(win, width=STIM_SIZE, height=STIM_SIZE, fillColorSpace='rgb', lineColorSpace='rgb'))
+# All 12 stimuli squares are drawn together in a single draw call
+stimuli = visual.ElementArrayStim(win, nElements=12, sizes=STIM_SIZE, elementTex=None, elementMask=None,
+                                  colorSpace='rgb', units='deg')
 
 # Present instructions for the experiment
 display_message(win, fixation, display_text, INS_MSG)
 
-# Open the output file reader for writing
-csv_file = open(subj_file, 'a')
-writer   = csv.writer(csv_file)
-
 # Set required run time variables
 current_trial = 0
+row_buffer    = []  # Trial results waiting to be written to file at the next break
 
 ########################################################################################################################
 #                                                  Experiment Run-time                                                 #
@@ -405,96 +401,77 @@ for trial in test_set:
 
     # Present a break message every 25 trials
     if current_trial % 25 == 0 and current_trial != 0:
+        writer.writerows(row_buffer)
+        csv_file.flush()
+        row_buffer.clear()
         display_message(win, fixation, display_text, BREAK_MSG)
 
     # Set up ITI screen
     fixation.setAutoDraw(True)
 
-    # Run ITI screen
+    # Run ITI screen, the fixation only screens (ITI and ISI) do not need a precise onset so these flips return
+    # without blocking for the vertical blank, the stimuli and probe flips still wait for it to keep their onset exact
     event_clock.reset()
+    win.waitBlanking = False
     win.flip()
+    win.waitBlanking = True
 
-    # Set up presentation stimuli screen
-    for target in xrange(trial.num_stimuli):
-        stimuli[target].setPos((trial.stim_positions[target][0], trial.stim_positions[target][1]))
-        stimuli[target].setFillColor(trial.stim_colors[target])
-        stimuli[target].setLineColor(trial.stim_colors[target])
-        stimuli[target].setAutoDraw(True)
+    # Set up presentation stimuli screen, only the fixation is auto drawn so the stimuli are drawn explicitly
+    stimuli.xys    = trial.pos_array
+    stimuli.colors = trial.color_array
+    stimuli.draw()
 
     # Wait until ITI screen is done
-    while event_clock.getTime() < ITI_TIME:
-        pass
+    core.wait(ITI_TIME - event_clock.getTime(), hogCPUperiod=HOG_TIME)
 
     # Run presentation stimuli screen
     event_clock.reset()
     win.flip()
 
-    # Set up ISI screen
-    for target in xrange(trial.num_stimuli):
-        stimuli[target].setAutoDraw(False)
+    # The ISI screen only shows the fixation so there is nothing to set up
 
     # Wait until presentation stimuli screen is done
-    while event_clock.getTime() < STIM_TIME:
-        pass
+    core.wait(STIM_TIME - event_clock.getTime(), hogCPUperiod=HOG_TIME)
 
     # Run ISI screen
     event_clock.reset()
+    win.waitBlanking = False
     win.flip()
+    win.waitBlanking = True
 
     # Set up memory probe screen
-    for target in xrange(trial.num_stimuli):
-        stimuli[target].setFillColor(trial.probe_colors[target])
-        stimuli[target].setLineColor(trial.probe_colors[target])
-        stimuli[target].setPos((trial.stim_positions[target][0], trial.stim_positions[target][1]))
-        stimuli[target].setAutoDraw(True)
+    stimuli.colors = trial.probe_color_array
+    stimuli.draw()
     event.clearEvents()
+    key_resp.clearEvents()
 
     # Wait until ISI screen is done
-    while event_clock.getTime() < DELAY_TIME:
-        pass
+    core.wait(DELAY_TIME - event_clock.getTime(), hogCPUperiod=HOG_TIME)
 
     # Run memory probe screen, wait for key response, and record
-    key_resp.clock.reset()
+    win.callOnFlip(key_resp.clock.reset)  # Response times are measured from the probe screen flip
     win.flip()
 
-    while True:
-        # Check for response keys or quit
-        if event.getKeys(["z"]):
-            response  = True
-            resp_time = key_resp.clock.getTime()
-            break
-        elif event.getKeys(["m"]):
-            response  = False
-            resp_time = key_resp.clock.getTime()
-            break
-        elif event.getKeys(["escape"]):
-            core.quit() # If escape key is hit then safely close program
+    # Block until a response key is hit, quit the program safely if escape is hit
+    key = key_resp.waitKeys(keyList=['z', 'm', 'escape'], waitRelease=False)[0]
+    resp_time = key.rt
+    if key.name == 'escape':
+        writer.writerows(row_buffer)  # Keep the results of completed trials
+        csv_file.close()
+        core.quit()
+    response = (key.name == 'z')
 
     # Output trial results to file
     output = [subj_num, current_trial, trial.num_stimuli]
-
-    for target in xrange(12):
-        try:
-            output.append(color_NAMES[str(trial.stim_colors[target])])
-        except:
-            output.append('NaN')
-
-    for target in xrange(12):
-        try:
-            output.append(color_NAMES[str(trial.probe_colors[target])])
-        except:
-            output.append('NaN')
-
+    output.extend(trial.stim_color_names)
+    output.extend(trial.probe_color_names)
     output.extend([trial.change, response, resp_time])
 
-    writer.writerow(output)
-    csv_file.flush()
-
-    for target in xrange(trial.num_stimuli):
-        stimuli[target].setAutoDraw(False)
+    row_buffer.append(output)
 # end of experiment
 
-# Close the csv file
+# Write any remaining trial results and close the csv file
+writer.writerows(row_buffer)
 csv_file.close()
 
 # Thank subject
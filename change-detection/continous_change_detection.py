@@ -28,7 +28,6 @@ import numpy as np
 from psychopy import visual, monitors, core, event, os, data, gui, misc, logging
 from psychopy.tools.monitorunittools import (cm2pix, deg2pix, pix2cm,
                                              pix2deg, convertToPix)
-from sklearn.metrics.pairwise import euclidean_distances
 
 try:
 	import matplotlib
@@ -66,10 +65,16 @@ TEXT_color   = [-1, -1, -1]  # The text color, currently white
 
 textureRes = 64
 n_circ = 360
+loop_radius = 8  # Number of visual degrees between the center and the color wheel
+
+# The mouse selects a color while within 0.5 visual degrees of the color wheel, stored as squared radii
+ring_inner_r2 = (loop_radius-0.5)**2
+ring_outer_r2 = (loop_radius+0.5)**2
 
 hsv = np.ones([n_circ,1,3], dtype=float)
 hsv[:,:,0] = np.linspace(0,360,n_circ, endpoint=False)[:,np.newaxis]
 rgb = misc.hsv2rgb(hsv)
+rgb = np.ascontiguousarray(rgb[:,0,:], dtype=np.float32)  # One rgb row per color wheel element
 TRIAL_colorS = [[-1, -1, -1],  # Black
                  [-1, -1, 1],   # Blue
                  [-1, 1, -1],   # Green
@@ -89,6 +94,10 @@ STIM_POS_RADIUS = 4  # Number of visual degrees between the center and stimuli
 STIM_SIZE       = 1  # Size of the stimuli in visual degrees, length and width
 STIM_THICKNESS  = 1  # The thickness of the outline of the stimuli
 
+# The 12 possible stimuli positions evenly spaced around the center, computed once for all trials
+STIM_ANGLES = np.arange(12) * (2 * np.pi / 12)
+STIM_RING   = np.stack([np.cos(STIM_ANGLES), np.sin(STIM_ANGLES)], axis=1) * STIM_POS_RADIUS
+
 TEXT_HEIGHT = 0.75   # The height in visual degrees of instruction text
 TEXT_WRAP   = 40  # The character limit of each line of text before word wrap
 
@@ -97,6 +106,7 @@ ITI_TIME   = 0.5  # The time in seconds between trials
 STIM_TIME  = 0.5  # The time in seconds to display the stimuli
 DELAY_TIME = 1.0  # The time in seconds between stimuli and probe
 BREAK_TIME = 0.75  # The time in seconds between break end and trial start
+HOG_TIME   = 0.002  # The time in seconds at the end of each wait where the CPU is hogged for accurate timing
 
 INS_MSG   = "You will be presented with colored squares, try to remember their colors.\n\n"
 INS_MSG  += "For each, trial there will follow a second set of squares in the same locations.\n\n"
@@ -152,47 +162,41 @@ class Trial(object):
             self.num_stimuli = 6
     # end def __init__
 
-    def set_positions(self):
+    def set_positions(self, position_order):
         """This function will determine the location (left or right) for the memory sample and distraction sample. Uses
         even and odd numbers to ensure an even distribution of left and right positioning. Also generates the
         coordinates for the gui and results print out.
 
-        """
+        position_order: numpy.ndarray
+            A random permutation of the 12 positions around the center.
 
-        # Generate a list of 12 positions around the center
-        for pos in range(12):
-            angle = math.radians(360 / 12 * pos)
-            self.stim_positions.append([math.cos(angle)*STIM_POS_RADIUS, math.sin(angle)*STIM_POS_RADIUS])
-        random.shuffle(self.stim_positions)  # Shuffle the list of positions
+        """
 
-        # Cut the position list to the correct number of stimuli required
-        self.stim_positions = self.stim_positions[:self.num_stimuli]
+        # Take the correct number of stimuli positions from the shuffled 12 positions around the center
+        self.stim_positions = STIM_RING[position_order[:self.num_stimuli]].tolist()
     # end def set_positions
 
-    def set_colors(self):
+    def set_colors(self, color_order):
         """This function is used to randomly generate memory stimuli colors and memory probe colors based on a color
         match or not.
 
+        color_order: numpy.ndarray
+            A random permutation of the indices into the list of available colors.
+
         """
 
-        # Shuffle the list of available colors
-        random.shuffle(TRIAL_colorS)
+        # Put the available colors in this trial's random order, leaving the module level color list untouched
+        colors = [TRIAL_colorS[idx] for idx in color_order]
 
-        # Create the lists of stimuli and probe colors
-        for color in TRIAL_colorS:
-            self.stim_colors.append(color)
-            self.probe_colors.append(color)
+        # Create the lists of stimuli and probe colors, cut to the correct number of stimuli required
+        self.stim_colors  = colors[:self.num_stimuli]
+        self.probe_colors = colors[:self.num_stimuli]
 
         # If a change is present replace on of the colors in the probe list with a new color
         if (self.rep_num % 2) == 0:
             self.change = True
-            rand_1 = random.randint(0, self.num_stimuli-1)
-            rand_2 = random.randint(self.num_stimuli, 7)
-            self.probe_colors[rand_1] = self.probe_colors[rand_2]
-
-        # Cut the color lists to the correct number of stimuli required
-        self.stim_colors  = self.stim_colors[:self.num_stimuli]
-        self.probe_colors = self.probe_colors[:self.num_stimuli]
+            rand_1, rand_2 = np.random.randint(0, self.num_stimuli), np.random.randint(self.num_stimuli, 8)
+            self.probe_colors[rand_1] = colors[rand_2]
     # end def set_colors
 
 # end class Trial
@@ -275,14 +279,20 @@ def set_trials():
 
     """
 
+    # Draw the random position and color orders for every trial at once
+    num_trials      = NUM_REPS * NUM_TYPE
+    position_orders = np.random.rand(num_trials, 12).argsort(axis=1)
+    color_orders    = np.random.rand(num_trials, len(TRIAL_colorS)).argsort(axis=1)
+
     # Build all trials before we start experiment
     test_set = []
 
     for rep in range(NUM_REPS):
         for trial in range(NUM_TYPE):
+            trial_idx = rep * NUM_TYPE + trial
             set_trial = Trial(trial, rep)  # Initialize the Trial
-            set_trial.set_positions()  # Set the stimuli positions for the Trial
-            set_trial.set_colors()  # Set the stimuli colors for the Trial
+            set_trial.set_positions(position_orders[trial_idx])  # Set the stimuli positions for the Trial
+            set_trial.set_colors(color_orders[trial_idx])  # Set the stimuli colors for the Trial
             test_set.append(set_trial)
 
     # Randomize our trial order
@@ -329,6 +339,9 @@ def display_fixation(win, clk, fix, dur):
     win: psychopy.visual.Window
         The window to write the message to.
 
+    clk: psychopy.core.Clock
+        The clock used to time the fixation screen.
+
     fix: psychopy.visual.Circle
         The fixation point to be removed from the screen.
 
@@ -337,15 +350,10 @@ def display_fixation(win, clk, fix, dur):
 
     """
 
-    event_clock.reset()
-
-    while True:
-        if clk.getTime() >= dur:
-            break
-        fix.draw(True)
-        win.flip()
-        if clk.getTime() >= dur:
-            break
+    clk.reset()
+    fix.draw()
+    win.flip()
+    core.wait(dur - clk.getTime(), hogCPUperiod=HOG_TIME)
 
     FT = clk.getTime()
 
@@ -403,8 +411,10 @@ def contains(thisElementArrayStim, x, y=None, units=None):
 		poly = thisElementArrayStim._borderPix  # e.g., outline vertices
 	else:
 		poly = thisElementArrayStim.verticesPix[:, :, 0:2]  # e.g., tesselated vertices
+	if np.ndim(poly) == 2:
+		poly = [poly]  # a single outline rather than a list of polygons
 
-	return any( np.fromiter( ( visual.helpers.pointInPolygon(xy[0], xy[1], thisPoly) for thisPoly in poly), np.bool ) )
+	return any(visual.helpers.pointInPolygon(xy[0], xy[1], thisPoly) for thisPoly in poly)
 
 def get_keypress():
     keys = event.getKeys()
@@ -433,6 +443,7 @@ if not os.path.exists(SAVE_PATH):
 
 # Seed random with the subject number so we can recreate the experiment
 random.seed(int(subj_num))
+np.random.seed(int(subj_num))
 
 # Write output headers to subject save file
 with open(subj_file, 'w') as csv_file:
@@ -455,10 +466,18 @@ stimuli = []
 for target in range(6):
     stimuli.append(visual.Rect(win, width=STIM_SIZE, height=STIM_SIZE, fillColorSpace='rgb', lineColorSpace=''))
 
+# The color wheel used to report the probe color is the same for every trial
+thetas = np.linspace(0, 2*np.pi, n_circ, endpoint=False)
+xys = np.stack([loop_radius*np.cos(thetas), loop_radius*np.sin(thetas)], axis=1)
+
+stim = visual.ElementArrayStim(win, nElements=n_circ,sizes=0.9,xys = xys,
+                       elementTex = None, elementMask = "circle",
+                       colors=rgb,colorSpace='rgb', interpolate = True)
+
 # Present instructions for the experiment
 display_message(win, fixation, display_text, INS_MSG)
 
-# Open the output file reader for writing
+# Open the output file reader for writing, rows are buffered and only flushed to disk at break screens
 csv_file = open(subj_file, 'a')
 writer   = csv.writer(csv_file)
 
@@ -472,6 +491,7 @@ current_trial = 0
 for trial in test_set:
     key = get_keypress()
     if key == 'escape':
+        csv_file.close()  # Keep the results of completed trials
         shutdown()
     else:
         pass
@@ -479,6 +499,7 @@ for trial in test_set:
 
     # Present a break message every 25 trials
     if current_trial % 25 == 0 and current_trial != 0:
+        csv_file.flush()
         display_message(win, fixation, display_text, BREAK_MSG)
 
     # Set up ITI screen
@@ -488,86 +509,55 @@ for trial in test_set:
     event_clock.reset()
     win.flip()
 
-    # Set up presentation stimuli screen
+    # Set up presentation stimuli screen, black stimuli are replaced by a random color from the color wheel
+    black_idx = np.random.randint(0, n_circ, size=trial.num_stimuli)
     for target in range(trial.num_stimuli):
         stimuli[target].setPos((trial.stim_positions[target][0], trial.stim_positions[target][1]))
 
         if trial.stim_colors[target]==[-1,-1,-1]:
-            ix = np.random.choice(np.arange(0,n_circ),1,replace=False)[0]
-            print (ix,len(rgb))
-            stimuli[target].setFillColor(rgb[ix,:,:][0], colorSpace = 'rgb')
+            ix = black_idx[target]
+            if VERBOSE:
+                logging.exp('Black stimulus replaced with color wheel index %d' % ix)
+            stimuli[target].setFillColor(rgb[ix], colorSpace = 'rgb')
         else:
             stimuli[target].setFillColor(trial.stim_colors[target], colorSpace = 'rgb')
         stimuli[target].setLineColor('Black')
         stimuli[target].setAutoDraw(True)
 
     # Wait until ITI screen is done
-    while event_clock.getTime() < ITI_TIME:
-        pass
+    core.wait(ITI_TIME - event_clock.getTime(), hogCPUperiod=HOG_TIME)
 
     # Run presentation stimuli screen
     event_clock.reset()
     win.flip()
 
-    probe_stim = stimuli
-    # Set up ISI screen
-    for target in range(trial.num_stimuli):
-        probe_stim[target].setFillColor(None)
-        probe_stim[target].setLineColor('Black')
-        probe_stim[target].setAutoDraw(True)
+    # Set up ISI screen, the stimuli outlines are already black and auto drawn so only the fill is removed
+    for target_stim in stimuli[:trial.num_stimuli]:
+        target_stim.setFillColor(None, log=False)
 
     # Wait until presentation stimuli screen is done
-    while event_clock.getTime() < STIM_TIME:
-        pass
+    core.wait(STIM_TIME - event_clock.getTime(), hogCPUperiod=HOG_TIME)
 
     # Run ISI screen
     event_clock.reset()
     win.flip()
 
     # Set up memory probe screen
-    xys = []
-    loop_radius = 8
-    n_circ =360
-    for theta in np.linspace(0,360,n_circ, endpoint = False):
-        xys.append((loop_radius * np.cos(theta*np.pi/180),
-                    loop_radius * np.sin(theta*np.pi/180)))
-
-    stim = visual.ElementArrayStim(win, nElements=n_circ,sizes=0.9,xys = xys,
-                           elementTex = None, elementMask = "circle",
-                           colors=rgb.reshape(n_circ,3),colorSpace='rgb', interpolate = True)
-
-    mask1 = visual.Circle(win,radius = loop_radius-0.5, units = 'deg')
-    mask1.units = 'deg'
-    mask2 = visual.Circle(win,radius = loop_radius+0.5, units = 'deg')
-    mask2.units = 'deg'
-
-    while event_clock.getTime() < 0.1:
-        pass
+    core.wait(0.1 - event_clock.getTime(), hogCPUperiod=HOG_TIME)
     event_clock.reset()
     win.flip()
-    probe = random.sample(np.arange(0,trial.num_stimuli),1)[0]
-    for target in range(trial.num_stimuli):
-        if target==probe:
-            probe_Color = trial.stim_colors[target]
-            probe_stim[target].setFillColor(None)
-            probe_stim[target].setLineColor('White')
-            probe_stim[target].setPos((trial.stim_positions[target][0], trial.stim_positions[target][1]))
-            probe_stim[target].setAutoDraw(True)
-        else:
-            probe_stim[target].setFillColor(None)
-            probe_stim[target].setLineColor('Black')
-            probe_stim[target].setPos((trial.stim_positions[target][0], trial.stim_positions[target][1]))
-            probe_stim[target].setAutoDraw(True)
+    probe = random.randrange(trial.num_stimuli)
+    # The probe screen is the ISI screen with the outline of the probed stimulus highlighted
+    probe_Color = trial.stim_colors[probe]
+    stimuli[probe].setLineColor('White', log=False)
     win.flip()
-    while event_clock.getTime() < 0.1:
-        pass
+    core.wait(0.1 - event_clock.getTime(), hogCPUperiod=HOG_TIME)
     event_clock.reset()
     stim.setAutoDraw(True)
     event.clearEvents()
 
     # Wait until ISI screen is done
-    while event_clock.getTime() < DELAY_TIME:
-        pass
+    core.wait(DELAY_TIME - event_clock.getTime(), hogCPUperiod=HOG_TIME)
 
     # Run memory probe screen, wait for key response, and record
     key_resp.clock.reset()
@@ -576,30 +566,23 @@ for trial in test_set:
     pressed = 1
     tic = event_clock.getTime()
     while pressed:
-        for target in range(trial.num_stimuli):
-            mousePos = tuple(mouse.getPos()) # Get mouse coordinates
-            loc = np.argmin(euclidean_distances(stim.xys,[mousePos]))
-            min_dist = np.min(euclidean_distances(stim.xys,[mousePos]))
-            if target==probe:
-                if not mask1.contains(mouse) and mask2.contains(mouse):
-                    probe_stim[target].setFillColor(rgb[loc,:,:][0], colorSpace= 'rgb')
-                else:
-                    probe_stim[target].setFillColor(None)
-
-                probe_stim[target].setLineColor('White')
-                probe_stim[target].setPos((trial.stim_positions[target][0], trial.stim_positions[target][1]))
-                probe_stim[target].setAutoDraw(True)
-            else:
-                probe_stim[target].setFillColor(None)
-                probe_stim[target].setLineColor('Black')
-                probe_stim[target].setPos((trial.stim_positions[target][0], trial.stim_positions[target][1]))
-                probe_stim[target].setAutoDraw(True)
+        # The color ring elements are evenly spaced by angle, so the element closest to the mouse is found from the
+        # mouse angle, this only depends on the mouse so is done once per frame
+        mx, my = mouse.getPos() # Get mouse coordinates once per frame
+        angle = math.atan2(my, mx)
+        loc = int(round(math.degrees(angle) * n_circ / 360.0)) % n_circ
+        # Only the probe fill color changes while responding, the rest of the probe screen was set up before
+        if ring_inner_r2 < mx*mx + my*my < ring_outer_r2:
+            stimuli[probe].setFillColor(rgb[loc], colorSpace= 'rgb')
+        else:
+            stimuli[probe].setFillColor(None)
 
         win.flip()
         buttons = mouse.getPressed()
         if any(buttons):
-            sub_resp_Color = rgb[loc,:,:][0]
-            judgement_Error = euclidean_distances([sub_resp_Color],[probe_Color]).flatten()
+            sub_resp_Color = rgb[loc]
+            # Kept as a one element array so the error column keeps its bracketed [0.123] format
+            judgement_Error = np.atleast_1d(np.linalg.norm(np.asarray(sub_resp_Color) - np.asarray(probe_Color)))
             pressed = 0
             toc = event_clock.getTime()
             response = toc-tic
@@ -618,7 +601,6 @@ for trial in test_set:
     output.extend([probe_Color,sub_resp_Color,judgement_Error, response])
 
     writer.writerow(output)
-    csv_file.flush()
 
     for target in range(trial.num_stimuli):
         stimuli[target].setAutoDraw(False)